@@ -0,0 +1,13 @@
+# gunicorn -c gunicorn_conf.py index:app
+# 音声合成は TTS API の待ち時間が大半なので、スレッドワーカーで待ちを重ねる
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8001")
+workers = int(os.environ.get("GUNICORN_WORKERS", 2))
+# /synthesize_stream は再生が終わるまでスレッドを 1 つ占有するので、同時再生数に合わせて多めに取る。
+# TTS API への同時リクエスト数は TTS_MAX_CONCURRENCY で別に抑えている
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+worker_class = "gthread"
+timeout = 120
+# ブラウザの Range リクエスト・連続再生で接続を使い回せるようにする
+keepalive = 5
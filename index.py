@@ -1,9 +1,27 @@
+import binascii
+import hashlib
+import io
+import itertools
+import json
 import os
 import re
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
 import time
-from datetime import datetime
-from flask import Flask, render_template, request, send_file
-from gtts import gTTS
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote
+from urllib.request import getproxies
+from xml.sax.saxutils import escape as xml_escape
+from flask import Flask, Response, after_this_request, render_template, request, send_file, stream_template, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+import requests
+from gtts import gTTS, gTTSError
+from requests.adapters import HTTPAdapter
+from werkzeug.security import safe_join
 try:
     from google.cloud import texttospeech
     GOOGLE_TTS_AVAILABLE = True
@@ -11,6 +29,29 @@ except ImportError:
     GOOGLE_TTS_AVAILABLE = False
     print("Google Cloud TTS not available, using gTTS")
 
+# ストリーミング合成（streaming_synthesize）は Chirp3-HD 音声のみ対応
+GOOGLE_TTS_STREAMING_AVAILABLE = GOOGLE_TTS_AVAILABLE and hasattr(texttospeech, "StreamingSynthesizeRequest")
+
+# クライアントの生成（認証情報の解決・gRPC チャネル）は重いので、最初に合成するときに 1 度だけ行い、全リクエストで共有する
+# （import 時に作ると起動が遅くなり、fork 前に作った gRPC チャネルは子プロセスで使えない）
+_TTS_CLIENT = None
+_tts_client_lock = threading.Lock()
+
+def get_tts_client():
+    """Google Cloud TTS のクライアントを返す（使えない環境では None）"""
+    global _TTS_CLIENT, GOOGLE_TTS_AVAILABLE, GOOGLE_TTS_STREAMING_AVAILABLE
+    if _TTS_CLIENT is not None or not GOOGLE_TTS_AVAILABLE:
+        return _TTS_CLIENT
+    with _tts_client_lock:
+        if _TTS_CLIENT is None and GOOGLE_TTS_AVAILABLE:
+            try:
+                _TTS_CLIENT = texttospeech.TextToSpeechClient()
+            except Exception as e:
+                GOOGLE_TTS_AVAILABLE = False
+                GOOGLE_TTS_STREAMING_AVAILABLE = False
+                print(f"Google Cloud TTS client init failed, using gTTS: {e}")
+    return _TTS_CLIENT
+
 # 音声ファイル結合用
 try:
     from pydub import AudioSegment
@@ -19,110 +60,572 @@ except ImportError:
     AUDIO_MERGE_AVAILABLE = False
     print("pydub not available, using simple concatenation")
 
+# JSON の読み書き（API レスポンス・キャッシュのメタデータ）用。orjson があれば C 実装で高速に処理する
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# gTTS は呼び出しごとに requests.Session を作り直す（毎回 TCP/TLS 接続からやり直しになる）ので、
+# 接続を使い回せるよう全スレッドで 1 つのセッションを共有する
+GTTS_SESSION = requests.Session()
+GTTS_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+_GTTS_AUDIO_RE = re.compile(r'jQ1olc","\[\\"(.*)\\"]')
+# gTTS と同じく証明書の検証を行わない（プロキシ・ファイアウォール対策）ので、urllib3 の警告を抑える
+requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+
+class KeepAliveGTTS(gTTS):
+    """共有セッションでリクエストを送る gTTS。
+    stream() は gTTS 2.5.4 の gTTS.stream の写し（非公開の _prepare_requests も使う）なので、
+    requirements.txt で gTTS==2.5.4 に固定している。gTTS を更新するときは本家の stream と見比べること"""
+
+    def stream(self):
+        for pr in self._prepare_requests():
+            try:
+                # 応答全体を溜めずに、受信しながら音声部分を取り出してデコードする
+                r = GTTS_SESSION.send(pr, verify=False, proxies=getproxies(), timeout=self.timeout, stream=True)
+                r.raise_for_status()
+            except requests.exceptions.HTTPError:
+                r.close()
+                raise gTTSError(tts=self, response=r)
+            except requests.exceptions.RequestException:
+                raise gTTSError(tts=self)
+
+            with r:
+                for line in r.iter_lines(chunk_size=1024):
+                    decoded_line = line.decode("utf-8")
+                    if "jQ1olc" in decoded_line:
+                        audio_search = _GTTS_AUDIO_RE.search(decoded_line)
+                        if not audio_search:
+                            raise gTTSError(tts=self, response=r)
+                        # b64decode の引数変換・ASCII へのエンコードを省いて、直接 C 実装でデコードする
+                        yield binascii.a2b_base64(audio_search.group(1))
+
+# ffmpeg があれば MP3 を再エンコードせずに結合できる
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask の JSON 変換（dict を返したときのレスポンスなど）を orjson で行う"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+def dump_json(obj):
+    """obj を UTF-8 の JSON バイト列にする"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def load_json(data):
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
 app = Flask(__name__)
+if ORJSON_AVAILABLE:
+    app.json = OrjsonProvider(app)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-here')
+# Apache（mod_xsendfile）/ lighttpd の配下では X-Sendfile でファイル本体の送信を任せる
+# （nginx は X-Sendfile に対応していないので AUDIO_ACCEL_REDIRECT_PREFIX を使う）
+app.config['USE_X_SENDFILE'] = os.environ.get('AUDIO_X_SENDFILE') == '1'
 
 VOICE_ID_man = 0
 VOICE_ID_woman = 1
 
+# 通常（非ストリーミング）合成用の音声
+GOOGLE_VOICES = {
+    VOICE_ID_man: "ja-JP-Wavenet-A",  # 男性の音声
+    VOICE_ID_woman: "ja-JP-Wavenet-C",  # 女性の音声
+}
+
+# ストリーミング合成用の音声と出力形式（ヘッダなしの 16bit PCM / モノラル。WAV ヘッダはこちらで付ける）
+GOOGLE_STREAMING_VOICES = {
+    VOICE_ID_man: "ja-JP-Chirp3-HD-Charon",
+    VOICE_ID_woman: "ja-JP-Chirp3-HD-Aoede",
+}
+# 音声は 22.05kHz でも十分聞き取れるので、Chirp3-HD 本来の 24kHz より下げて送信量を減らす
+GOOGLE_STREAMING_SAMPLE_RATE = 22050
+
 # 保存ディレクトリ
 OUTPUT_DIR = os.environ.get('AUDIO_OUTPUT_DIR', 'audio_output')
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# nginx 配下では /audio の配信を X-Accel-Redirect で nginx に任せる（例: "/__audio/"）
+AUDIO_ACCEL_REDIRECT_PREFIX = os.environ.get('AUDIO_ACCEL_REDIRECT_PREFIX', '')
+# /audio のファイルは一度書いたら内容が変わらないので、ブラウザに 1 日キャッシュさせる
+AUDIO_MAX_AGE = 24 * 60 * 60  # 秒
+
+# 合成済み音声のキャッシュ（sha256(lang|voice|text).mp3 / .pcm と TTL 用のメタデータ JSON）
+CACHE_DIR = os.path.join(OUTPUT_DIR, 'cache')
+CACHE_AUDIO_EXTS = (".mp3", ".pcm")  # .pcm はストリーミング合成の PCM（ヘッダなし）
+CACHE_TTL = int(os.environ.get('AUDIO_CACHE_TTL', 7 * 24 * 60 * 60))  # 秒
+CACHE_MAX_BYTES = int(os.environ.get('AUDIO_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+CACHE_EVICT_RATIO = 0.9  # 上限を超えたらこの割合まで減らす
+CACHE_EVICT_MIN_AGE = 60  # 秒。直近に使われた（配信中かもしれない）ものは削除しない
+_cache_size = None  # 起動後に初めて書き込むまでは未計測
+_cache_lock = threading.Lock()
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# 並列合成の設定
+SYNTH_MAX_WORKERS = 8
+# プロセス全体で同時に投げる TTS リクエストの上限（複数リクエストが重なっても API の制限を超えないように）
+TTS_MAX_CONCURRENCY = int(os.environ.get('TTS_MAX_CONCURRENCY', 8))
+_tts_semaphore = threading.BoundedSemaphore(TTS_MAX_CONCURRENCY)
+SYNTH_RETRIES = 3
+SYNTH_RETRY_BASE_DELAY = 0.5  # 秒（試行ごとに倍）
+# 1 回の合成リクエストにまとめるテキストの最大文字数（リクエストごとの固定オーバーヘッドを減らす）
+BATCH_MAX_CHARS = 200
+# まとめたセリフの区切り。SSML が使える Google TTS では区切りごとに間を入れる
+BATCH_SEPARATOR = "\n"
+BATCH_PAUSE_MS = 400
+
+# gTTS / Google TTS の MP3 出力形式（24kHz モノラル）。加工・無音もこれに揃えて結合できるようにする
+MP3_SAMPLE_RATE = 24000
+MP3_BITRATE = "32k"
+
+# gTTS フォールバック時の男性話者のピッチ（再生レートの倍率）
+MALE_PITCH_FACTOR = 0.6
+
+# セリフ間の無音
+SILENCE_DURATION_MS = 500
+SILENCE_PATH = os.path.join(OUTPUT_DIR, f"silence_{SILENCE_DURATION_MS}ms.mp3")
+# ファイル連結時のコピー単位
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# ストリーミング（PCM 16bit モノラル）用の無音。不変なので全リクエストで同じバッファを送る
+PCM_SILENCE = bytes(GOOGLE_STREAMING_SAMPLE_RATE * SILENCE_DURATION_MS // 1000 * 2)
+_silence_lock = threading.Lock()
+
+# ストリーミング配信のチャンクサイズ（行の先頭は小さく送り、倍々で上限まで増やす）と、
+# 配信中に先行して合成する並列数
+STREAM_FIRST_CHUNK_SIZE = 1024
+STREAM_MAX_CHUNK_SIZE = 16384
+STREAM_PREFETCH_WORKERS = 3
+
+# text.txt の解析用
+_SERIFU_PREFIX = "セリフ:"
+_SPEAKER_LINE_RE = re.compile(r'\n[^\S\n]*\[(男性|女性)\][^\n]*')
+_LINE_BREAK_RE = re.compile(r'\s*\n\s*')
+# str.splitlines() が改行とみなす \n 以外の文字（CR のみの改行など）。含まれるときだけ分割の前に \n に揃える
+_OTHER_LINE_BREAKS = "\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+_NEWLINE_RE = re.compile(r'\r\n|[\r\x0b\x0c\x1c-\x1e\x85\u2028\u2029]')
+
+# 新しく作るファイルの権限（umask は読むと書き換わるので、起動時に 1 度だけ読んで戻す）
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# 結合ファイル名の連番（プロセス内で一意）
+_FILENAME_SEQ = itertools.count()
+
+# 解析済みの text.txt（パス -> {"key": (st_mtime_ns, st_size), "lines": 行データ, "batches": compact_lines の結果}）
+_TEXT_CACHE = {}
+
 def clean_text(text):
-    text = re.sub(r'^セリフ:\s*', '', text)
+    # 先頭の「セリフ:」は固定の文字列なので、正規表現を使わずに取り除く（後ろの空白は strip で消える）
+    if text.startswith(_SERIFU_PREFIX):
+        text = text[len(_SERIFU_PREFIX):]
     return text.strip()
 
 def get_text_file_path():
     return os.path.join(os.path.dirname(__file__), "text.txt")
 
 def generate_filename():
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    return f"voice_dialogue_{timestamp}.mp3"
+    # 同時に合成しても重ならないよう、ミリ秒の時刻にプロセス ID と連番を付ける
+    return f"voice_dialogue_{int(time.time() * 1000):013d}_{os.getpid()}_{next(_FILENAME_SEQ):04d}.mp3"
+
+def new_temp_path(prefix, suffix=".mp3", directory=None):
+    """他のスレッド・プロセスと衝突しない一時ファイルを作成し、そのパスを返す"""
+    with tempfile.NamedTemporaryFile(dir=directory or OUTPUT_DIR, prefix=prefix,
+                                     suffix=suffix, delete=False) as f:
+        # tempfile は 0600 で作るので、通常のファイルと同じ権限にする
+        # （キャッシュにそのまま移すので、別ユーザーの nginx / Apache からも読めるように）
+        os.chmod(f.name, 0o666 & ~_UMASK)
+        return f.name
+
+def discard_file(path):
+    """書きかけ・不要になったファイルを削除する（存在しなければ何もしない）"""
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def batch_to_ssml(text):
+    """compact_lines でまとめたテキストを、セリフ間に間を入れた SSML にする"""
+    pause = f'<break time="{BATCH_PAUSE_MS}ms"/>'
+    return "<speak>" + pause.join(xml_escape(part) for part in text.split(BATCH_SEPARATOR)) + "</speak>"
 
 def synthesize_text_google_tts(text, speaker_id=0):
     """Google Cloud TTS で音声を生成（男性・女性の音声を明確に区別）"""
-    if not GOOGLE_TTS_AVAILABLE:
+    client = get_tts_client()
+    if client is None:
         return None
     
+    temp_filepath = None
     try:
-        client = texttospeech.TextToSpeechClient()
-        
-        # 話者に応じて音声を選択
-        if speaker_id == VOICE_ID_man:
-            voice_name = "ja-JP-Wavenet-A"  # 男性の音声
-        else:
-            voice_name = "ja-JP-Wavenet-C"  # 女性の音声
-        
-        synthesis_input = texttospeech.SynthesisInput(text=text)
-        voice = texttospeech.VoiceSelectionParams(
-            language_code="ja-JP",
-            name=voice_name
-        )
+        # gTTS の MP3 や無音と再エンコードなし（-c copy）で結合できるよう、サンプルレートを揃える
         audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3
+            audio_encoding=texttospeech.AudioEncoding.MP3,
+            sample_rate_hertz=MP3_SAMPLE_RATE
         )
+        audio_content = request_google_tts(client, text, speaker_id, audio_config)
         
-        response = client.synthesize_speech(
-            input=synthesis_input,
-            voice=voice,
-            audio_config=audio_config
-        )
-        
-        temp_filename = f"temp_google_{int(time.time()*1000)}_{speaker_id}.mp3"
-        temp_filepath = os.path.join(OUTPUT_DIR, temp_filename)
-        
+        temp_filepath = new_temp_path(f"temp_google_{speaker_id}_")
         with open(temp_filepath, "wb") as out:
-            out.write(response.audio_content)
+            out.write(audio_content)
         
         return temp_filepath
         
+    except Exception as e:
+        print(f"Google TTS synth failed: {e}")
+        discard_file(temp_filepath)
+        return None
+
+def request_google_tts(client, text, speaker_id, audio_config):
+    """通常（非ストリーミング）の Google TTS で合成し、音声データを返す"""
+    # 話者に応じて音声を選択
+    voice_name = GOOGLE_VOICES.get(speaker_id, GOOGLE_VOICES[VOICE_ID_woman])
+    
+    if BATCH_SEPARATOR in text:
+        synthesis_input = texttospeech.SynthesisInput(ssml=batch_to_ssml(text))
+    else:
+        synthesis_input = texttospeech.SynthesisInput(text=text)
+    voice = texttospeech.VoiceSelectionParams(
+        language_code="ja-JP",
+        name=voice_name
+    )
+    response = client.synthesize_speech(
+        input=synthesis_input,
+        voice=voice,
+        audio_config=audio_config
+    )
+    return response.audio_content
+
+def synthesize_pcm_google_tts(text, speaker_id=0):
+    """通常の Google TTS で、ストリーミング合成と同じ形式の PCM を生成する（ストリーミング合成に失敗した行の代替）"""
+    client = get_tts_client()
+    if client is None:
+        return None
+    try:
+        audio_config = texttospeech.AudioConfig(
+            audio_encoding=texttospeech.AudioEncoding.LINEAR16,
+            sample_rate_hertz=GOOGLE_STREAMING_SAMPLE_RATE
+        )
+        with _tts_semaphore:
+            audio_content = request_google_tts(client, text, speaker_id, audio_config)
+        # LINEAR16 は WAV ヘッダ付きで返るので、PCM 部分だけにする
+        return wav_pcm_data(audio_content)
     except Exception as e:
         print(f"Google TTS synth failed: {e}")
         return None
 
+def stream_text_google_tts(text, speaker_id=0):
+    """Google Cloud TTS のストリーミング合成で、PCM を生成された順に返す"""
+    config_request = texttospeech.StreamingSynthesizeRequest(
+        streaming_config=texttospeech.StreamingSynthesizeConfig(
+            voice=texttospeech.VoiceSelectionParams(
+                language_code="ja-JP",
+                name=GOOGLE_STREAMING_VOICES.get(speaker_id, GOOGLE_STREAMING_VOICES[VOICE_ID_woman])
+            ),
+            # MP3 はサーバー側でフレーム単位のバッファリングが入るため、最初の音までが遅い
+            streaming_audio_config=texttospeech.StreamingAudioConfig(
+                audio_encoding=texttospeech.AudioEncoding.PCM,
+                sample_rate_hertz=GOOGLE_STREAMING_SAMPLE_RATE
+            )
+        )
+    )
+    text_request = texttospeech.StreamingSynthesizeRequest(
+        # Chirp3-HD のストリーミング合成は SSML 非対応
+        input=texttospeech.StreamingSynthesisInput(text=text.replace(BATCH_SEPARATOR, " "))
+    )
+    for response in get_tts_client().streaming_synthesize(iter([config_request, text_request])):
+        yield response.audio_content
+
+def lower_pitch_mp3(mp3_bytes, output_path):
+    """再生レートを下げてから元のレートにリサンプルし、MP3 のピッチを下げる（ffmpeg 1 回で処理）"""
+    subprocess.run([
+        FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-y", "-f", "mp3", "-i", "pipe:0",
+        "-af", f"asetrate={int(MP3_SAMPLE_RATE * MALE_PITCH_FACTOR)},aresample={MP3_SAMPLE_RATE}",
+        "-ac", "1", "-c:a", "libmp3lame", "-b:a", MP3_BITRATE, output_path,
+    ], input=mp3_bytes, check=True, capture_output=True)
+
 def synthesize_text_gtts(text, speaker_id=0):
-    """gTTS で音声を生成（フォールバック用）"""
+    """gTTS で音声を生成（フォールバック用）。(ファイルパス, キャッシュキー用の音声の識別子) を返す"""
+    temp_filepath = None
     try:
-        # 話者に応じてテキストを調整
-        if speaker_id == VOICE_ID_man:
-            adjusted_text = f"{text}"
-        else:
-            adjusted_text = f"{text}"
-        
-        tts = gTTS(text=adjusted_text, lang="ja")
-        temp_filename = f"temp_gtts_{int(time.time()*1000)}_{speaker_id}.mp3"
-        temp_filepath = os.path.join(OUTPUT_DIR, temp_filename)
-        tts.save(temp_filepath)
+        # gTTS は SSML 非対応なので、まとめたセリフは空白で繋ぐ
+        tts = KeepAliveGTTS(text=text.replace(BATCH_SEPARATOR, " "), lang="ja")
+        temp_filepath = new_temp_path(f"temp_gtts_{speaker_id}_")
 
-        # 男性話者のとき、pydub が使える環境では少しだけピッチを下げて男性っぽく加工
-        if speaker_id == VOICE_ID_man and AUDIO_MERGE_AVAILABLE:
+        # 男性話者のとき、ffmpeg が使える環境ではピッチを下げて男性っぽく加工
+        # （合成結果はメモリ上で受け取り、加工後の 1 回だけファイルに書く）
+        if speaker_id == VOICE_ID_man and FFMPEG_PATH:
+            buf = io.BytesIO()
+            tts.write_to_fp(buf)
             try:
-                audio_seg = AudioSegment.from_file(temp_filepath)
-                # おおよそ -2 semitones 相当（約 0.89 倍）。
-                # frame_rate を下げてから元の frame_rate に戻すことでピッチのみ変化させる手法。
-                lowered = audio_seg._spawn(audio_seg.raw_data, overrides={
-                    "frame_rate": int(audio_seg.frame_rate * 0.6)
-                }).set_frame_rate(audio_seg.frame_rate)
-                lowered.export(temp_filepath, format="mp3")
+                lower_pitch_mp3(buf.getvalue(), temp_filepath)
                 print("男性（gTTSフォールバック）用にピッチを少し下げました:", temp_filepath)
-            except Exception as e:
+                return temp_filepath, gtts_voice_signature(MALE_PITCH_FACTOR)
+            except (OSError, subprocess.CalledProcessError) as e:
                 print(f"男性用ピッチ加工に失敗（gTTSフォールバック）: {e}")
-        
-        return temp_filepath
+            # 加工できなかった音声は、加工なしの gTTS 音声として扱う
+            with open(temp_filepath, "wb") as f:
+                f.write(buf.getvalue())
+            return temp_filepath, gtts_voice_signature(1.0)
+
+        tts.save(temp_filepath)
+        return temp_filepath, get_voice_signature(speaker_id, "gtts")
     except Exception as e:
         print(f"gTTS synth failed: {e}")
-        return None
+        discard_file(temp_filepath)
+        return None, None
 
-def synthesize_text(text, speaker_id=0):
-    """音声合成（Google TTS優先、gTTSフォールバック）"""
+def synthesize_text(text, speaker_id=0, lang="ja"):
+    """音声合成（Google TTS優先、gTTSフォールバック）。各エンジンを呼ぶ前にそのエンジンのキャッシュを確認する。
+    (ファイルパス, 音声の識別子) を返す（キャッシュから返した場合、識別子は None）"""
     # Google TTSを試行
-    result = synthesize_text_google_tts(text, speaker_id)
-    if result:
-        return result
-    
-    # Google TTSが失敗した場合はgTTSを使用
-    return synthesize_text_gtts(text, speaker_id)
+    if get_tts_client():
+        voice = get_voice_signature(speaker_id, "google")
+        cached = find_cached_audio(text, voice, lang)
+        if cached:
+            return cached, None
+        with _tts_semaphore:
+            result = synthesize_text_google_tts(text, speaker_id)
+        if result:
+            return result, voice
+
+    # Google TTSが失敗した場合はgTTSを使用（以前のフォールバックで保存した音声があればそれを使う）
+    cached = find_cached_audio(text, get_voice_signature(speaker_id, "gtts"), lang)
+    if cached:
+        return cached, None
+    with _tts_semaphore:
+        return synthesize_text_gtts(text, speaker_id)
+
+def synthesize_text_with_retry(text, speaker_id=0, lang="ja"):
+    """音声合成（レート制限対策として指数バックオフで再試行）"""
+    for attempt in range(SYNTH_RETRIES):
+        result = synthesize_text(text, speaker_id, lang)
+        if result[0]:
+            return result
+        if attempt + 1 < SYNTH_RETRIES:
+            delay = SYNTH_RETRY_BASE_DELAY * (2 ** attempt)
+            print(f"音声生成を再試行します（{delay}秒後）: {text}")
+            time.sleep(delay)
+    return None, None
+
+def get_voice_signature(speaker_id, engine):
+    """キャッシュキー用の音声の識別子（同じテキストでも音声・加工が違えば別の音声になる）"""
+    if engine == "google":
+        return "google:" + GOOGLE_VOICES.get(speaker_id, GOOGLE_VOICES[VOICE_ID_woman])
+    if engine == "google_stream":
+        voice = GOOGLE_STREAMING_VOICES.get(speaker_id, GOOGLE_STREAMING_VOICES[VOICE_ID_woman])
+        return f"google_stream:{voice}:pcm{GOOGLE_STREAMING_SAMPLE_RATE}"
+    pitch = MALE_PITCH_FACTOR if speaker_id == VOICE_ID_man and FFMPEG_PATH else 1.0
+    return gtts_voice_signature(pitch)
+
+def gtts_voice_signature(pitch):
+    return f"gtts:pitch={pitch}"
+
+def get_cache_paths(text, voice, lang, ext=".mp3"):
+    key = hashlib.sha256(f"{lang}|{voice}|{text}".encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, key + ext), os.path.join(CACHE_DIR, key + ".json")
+
+def is_cached_file(path):
+    return os.path.dirname(os.path.abspath(path)) == os.path.abspath(CACHE_DIR)
+
+def load_cached_audio(cache_path, meta_path):
+    """キャッシュが有効ならそのパスを返す（期限切れのものは削除する）"""
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(meta_path, 'rb') as f:
+            created = load_json(f.read())["created"]
+    except (OSError, ValueError, KeyError):
+        created = None
+    if created is not None and time.time() - created < CACHE_TTL:
+        # 最終利用時刻として mtime を更新する（LRU 削除の基準。atime は noatime/relatime で当てにならない）
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+        return cache_path
+    for path in (cache_path, meta_path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return None
+
+def find_cached_audio(text, voice, lang, ext=".mp3"):
+    cached = load_cached_audio(*get_cache_paths(text, voice, lang, ext))
+    if cached:
+        print(f"キャッシュを使用: {cached}")
+    return cached
+
+def evict_cache(added_bytes):
+    """キャッシュの合計サイズが上限を超えたら、最後に使われたのが古いものから削除する"""
+    global _cache_size
+    with _cache_lock:
+        if _cache_size is not None:
+            _cache_size += added_bytes
+            if _cache_size <= CACHE_MAX_BYTES:
+                return
+        # 他のワーカープロセスも書き込むので、実際のサイズは都度数え直す
+        entries = []
+        for name in os.listdir(CACHE_DIR):
+            if not name.endswith(CACHE_AUDIO_EXTS):
+                continue
+            path = os.path.join(CACHE_DIR, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, path, st.st_size))
+        total = sum(size for _, _, size in entries)
+        if total > CACHE_MAX_BYTES:
+            entries.sort()
+            now = time.time()
+            for mtime, path, size in entries:
+                if total <= CACHE_MAX_BYTES * CACHE_EVICT_RATIO or now - mtime < CACHE_EVICT_MIN_AGE:
+                    break
+                discard_file(path)
+                discard_file(os.path.splitext(path)[0] + ".json")
+                total -= size
+            print(f"キャッシュを整理しました: {total} bytes")
+        _cache_size = total
+
+def cached_synth(text, speaker_id=0, lang="ja"):
+    """キャッシュ付き音声合成（同じテキスト・音声なら TTS を呼ばない）"""
+    temp_path, voice = synthesize_text_with_retry(text, speaker_id, lang)
+    if not temp_path or voice is None:
+        return temp_path
+    # 実際に使われたエンジン・加工の音声として保存する（Google TTS が失敗した場合は gTTS の音声になる）
+    return store_cached_audio(temp_path, text, voice, speaker_id, lang)
+
+def store_cached_audio(temp_path, text, voice, speaker_id, lang, ext=".mp3"):
+    """合成した一時ファイルをキャッシュに移して、そのパスを返す（保存できなければ一時ファイルのまま返す）"""
+    cache_path, meta_path = get_cache_paths(text, voice, lang, ext)
+    try:
+        # 同一ファイルシステム上の os.replace はアトミック。
+        # 音声より先にメタデータを置く（音声だけがある瞬間を他のスレッドが見ると、期限切れとして削除されてしまう）
+        meta_temp = new_temp_path("meta_", suffix=".tmp", directory=CACHE_DIR)
+        with open(meta_temp, 'wb') as f:
+            f.write(dump_json({"created": time.time(), "lang": lang, "speaker": speaker_id,
+                               "voice": voice, "text": text}))
+        os.replace(meta_temp, meta_path)
+        os.replace(temp_path, cache_path)
+        evict_cache(os.path.getsize(cache_path))
+    except OSError as e:
+        print(f"キャッシュ保存に失敗: {e}")
+        return temp_path if os.path.exists(temp_path) else cache_path
+    return cache_path
+
+def compact_lines(lines, max_chars=BATCH_MAX_CHARS):
+    """同じ話者が続く短いセリフを 1 回の合成リクエストにまとめる（テキストは clean_text 済みになる）"""
+    batches = []
+    for line in lines:
+        text = clean_text(line["text"])
+        if not text:
+            continue
+        last = batches[-1] if batches else None
+        if last and last["id"] == line["id"] and len(last["text"]) + 1 + len(text) <= max_chars:
+            last["text"] += BATCH_SEPARATOR + text
+        else:
+            batches.append({"text": text, "id": line["id"]})
+    return batches
+
+def remove_temp_files(paths):
+    for temp_file in paths:
+        try:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+                print(f"一時ファイルを削除: {temp_file}")
+        except Exception as e:
+            print(f"一時ファイル削除エラー: {e}")
+
+def synthesize_lines(lines):
+    """compact_lines でまとめた行を並列に音声合成する（結果は lines と同じ順序）"""
+    jobs = [(line["text"], line["id"]) for line in lines]
+    # 同じ話者の同じセリフは 1 回だけ合成し、結果のファイルを使い回す
+    unique_jobs = list(dict.fromkeys(jobs))
+    with ThreadPoolExecutor(max_workers=min(SYNTH_MAX_WORKERS, len(unique_jobs))) as ex:
+        results = dict(zip(unique_jobs, ex.map(lambda job: cached_synth(*job), unique_jobs)))
+    return [results[job] for job in jobs]
+
+def get_silence_path():
+    """セリフ間に挟む無音 MP3 を（初回のみ）生成して返す"""
+    with _silence_lock:
+        if not os.path.exists(SILENCE_PATH):
+            temp_path = new_temp_path("silence_")
+            try:
+                subprocess.run([
+                    FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-y",
+                    "-f", "lavfi", "-i", f"anullsrc=r={MP3_SAMPLE_RATE}:cl=mono",
+                    "-t", str(SILENCE_DURATION_MS / 1000), "-c:a", "libmp3lame", "-b:a", MP3_BITRATE,
+                    temp_path,
+                ], check=True, capture_output=True)
+                os.replace(temp_path, SILENCE_PATH)
+            except (OSError, subprocess.CalledProcessError):
+                discard_file(temp_path)
+                raise
+    return SILENCE_PATH
+
+def combine_audio_files_ffmpeg(audio_files, output_path):
+    """ffmpeg の concat demuxer で MP3 フレームをそのままコピーして結合する"""
+    silence_path = get_silence_path()
+    entries = []
+    for audio_file in audio_files:
+        if os.path.exists(audio_file):
+            entries.extend([audio_file, silence_path])
+
+    # 結合リストはファイルに書かず ffmpeg の標準入力に渡す（パイプ入力のため各エントリは file: で明示する）
+    concat_list = "".join(
+        "file 'file:{}'\n".format(os.path.abspath(entry).replace("'", "'\\''"))
+        for entry in entries
+    )
+    subprocess.run([
+        FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,pipe", "-i", "pipe:0",
+        "-c", "copy", output_path,
+    ], input=concat_list.encode("utf-8"), check=True, capture_output=True)
+    return output_path
+
+def append_file(src, out):
+    """src の中身を out の末尾に追記する（Linux では sendfile でカーネル内コピー）"""
+    out.flush()
+    offset = 0
+    if hasattr(os, "sendfile"):
+        try:
+            while True:
+                sent = os.sendfile(out.fileno(), src.fileno(), offset, COPY_BUFFER_SIZE)
+                if sent == 0:
+                    return
+                offset += sent
+        except OSError:
+            # ファイル間の sendfile に対応していない環境では通常のコピーに切り替える
+            pass
+    src.seek(offset)
+    out.seek(0, os.SEEK_END)
+    shutil.copyfileobj(src, out, COPY_BUFFER_SIZE)
+
+def concat_mp3_files(audio_files, output_path):
+    """MP3 ファイルをバイト列のまま連結する（デコードせず、ファイル間で直接コピー）"""
+    # 無音ファイルが生成済みならセリフ間に挟む
+    silence_path = SILENCE_PATH if os.path.exists(SILENCE_PATH) else None
+    with open(output_path, "wb") as out:
+        for audio_file in audio_files:
+            if not os.path.exists(audio_file):
+                continue
+            for path in (audio_file, silence_path):
+                if path:
+                    with open(path, "rb") as src:
+                        append_file(src, out)
+    return output_path
 
 def combine_audio_files(audio_files, output_path):
     """複数の音声ファイルを結合する"""
@@ -131,72 +634,90 @@ def combine_audio_files(audio_files, output_path):
     
     if len(audio_files) == 1:
         # ファイルが1つだけの場合はコピー
-        import shutil
-        shutil.copy2(audio_files[0], output_path)
+        shutil.copyfile(audio_files[0], output_path)
         return output_path
     
+    if FFMPEG_PATH:
+        # 再エンコードなしで結合
+        try:
+            return combine_audio_files_ffmpeg(audio_files, output_path)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"ffmpeg結合に失敗: {e}")
+
     if AUDIO_MERGE_AVAILABLE:
         # pydubを使用して結合
         try:
-            combined = AudioSegment.empty()
-            for audio_file in audio_files:
-                if os.path.exists(audio_file):
-                    audio = AudioSegment.from_file(audio_file)
-                    combined += audio
-                    # セリフ間に短い間隔を追加
-                    combined += AudioSegment.silent(duration=500)  # 0.5秒の無音
+            segments = [AudioSegment.from_file(f) for f in audio_files if os.path.exists(f)]
+            # += で 1 つずつ足すと毎回全体がコピーされるので、先頭のセリフに形式を揃えてから PCM を 1 回で連結する
+            first = segments[0]
+            segments = [
+                segment.set_frame_rate(first.frame_rate).set_channels(first.channels).set_sample_width(first.sample_width)
+                for segment in segments
+            ]
+            # セリフ間に短い間隔を追加
+            silence = AudioSegment.silent(duration=SILENCE_DURATION_MS, frame_rate=first.frame_rate)
+            silence = silence.set_channels(first.channels).set_sample_width(first.sample_width)
+            combined = first._spawn(b"".join(
+                data for segment in segments for data in (segment.raw_data, silence.raw_data)
+            ))
             
             combined.export(output_path, format="mp3")
             return output_path
         except Exception as e:
             print(f"pydub結合に失敗: {e}")
-            # フォールバック: 最初のファイルをコピー
-            import shutil
-            shutil.copy2(audio_files[0], output_path)
-            return output_path
-    else:
-        # pydubが利用できない場合は最初のファイルをコピー
-        import shutil
-        shutil.copy2(audio_files[0], output_path)
-        return output_path
+
+    # MP3 フレームは自己同期的なので、ファイルをそのまま繋げるだけでも再生できる
+    return concat_mp3_files(audio_files, output_path)
 
 def parse_text_content(text_content):
     """text.txt を行データに変換"""
+    # Windows で保存された CRLF は str.replace で先に揃える（正規表現で全体を置換するより何倍も速い）
+    if "\r\n" in text_content:
+        text_content = text_content.replace("\r\n", "\n")
+    if any(c in text_content for c in _OTHER_LINE_BREAKS):
+        text_content = _NEWLINE_RE.sub("\n", text_content)
+    # 話者タグ行で 1 回だけ分割する: [前置き, 話者, 本文, 話者, 本文, ...]
+    parts = _SPEAKER_LINE_RE.split("\n" + text_content)
     lines = []
-    current_speaker = None
-    current_text = []
-
-    for raw in text_content.splitlines():
-        text = raw.strip()
-        if not text:
-            continue
-        speaker_match = re.match(r'\[(男性|女性)\]', text)
-        if speaker_match:
-            if current_speaker is not None and current_text:
-                speaker_id = VOICE_ID_man if current_speaker == "男性" else VOICE_ID_woman
-                lines.append({"text": " ".join(current_text), "id": speaker_id})
-                current_text = []
-            current_speaker = speaker_match.group(1)
-            continue
-        if current_speaker is not None:
-            current_text.append(text)
-
-    if current_speaker is not None and current_text:
-        speaker_id = VOICE_ID_man if current_speaker == "男性" else VOICE_ID_woman
-        lines.append({"text": " ".join(current_text), "id": speaker_id})
+    for i in range(1, len(parts), 2):
+        text = parts[i + 1].strip()
+        if "\n" in text:
+            text = _LINE_BREAK_RE.sub(' ', text)
+        if text:
+            speaker_id = VOICE_ID_man if parts[i] == "男性" else VOICE_ID_woman
+            lines.append({"text": text, "id": speaker_id})
+    return lines
 
+def get_lines(file_path):
+    """text.txt を解析した行データを返す（更新時刻かサイズが変わったときだけ読み直す）"""
+    st = os.stat(file_path)
+    # mtime の分解能が粗いファイルシステムでも、同じ時刻内の書き換えをサイズの変化で検出する
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _TEXT_CACHE.get(file_path)
+    if cached and cached["key"] == key:
+        return cached["lines"]
+    with open(file_path, 'r', encoding='utf-8') as f:
+        lines = parse_text_content(f.read())
+    _TEXT_CACHE[file_path] = {"key": key, "lines": lines, "batches": None}
     return lines
 
+def get_batches(file_path):
+    """get_lines の結果を compact_lines でまとめたもの（text.txt が変わらない限り使い回す）"""
+    get_lines(file_path)
+    cached = _TEXT_CACHE[file_path]
+    if cached["batches"] is None:
+        cached["batches"] = compact_lines(cached["lines"])
+    return cached["batches"]
+
 @app.route("/")
 def index():
     try:
         file_path = get_text_file_path()
         if not os.path.exists(file_path):
             return render_template("index.html", error="text.txtが見つかりません")
-        with open(file_path, 'r', encoding='utf-8') as f:
-            text_content = f.read()
-        lines = parse_text_content(text_content)
-        return render_template("index.html", lines=lines)
+        lines = get_lines(file_path)
+        # 描画できた部分から順に送る（台本が長くても先頭の静的部分はすぐ届く）
+        return Response(stream_template("index.html", lines=lines))
     except Exception as e:
         return render_template("index.html", error=f"エラー: {e}")
 
@@ -206,23 +727,19 @@ def synthesize():
         file_path = get_text_file_path()
         if not os.path.exists(file_path):
             return {"error": "text.txtがありません"}, 400
-        with open(file_path, 'r', encoding='utf-8') as f:
-            text_content = f.read()
-        lines = parse_text_content(text_content)
+        lines = get_batches(file_path)
         if not lines:
             return {"error": "合成するデータがありません"}, 400
 
-        # 各話者ごとに音声を生成
+        # 各話者ごとに音声を並列生成
+        print(f"{len(lines)}行の音声を並列生成中...")
         temp_files = []
-        for line in lines:
-            cleaned_text = clean_text(line["text"])
-            print(f"音声生成中: {cleaned_text} (話者: {'男性' if line['id'] == VOICE_ID_man else '女性'})")
-            audio_path = synthesize_text(cleaned_text, line["id"])
+        for line, audio_path in zip(lines, synthesize_lines(lines)):
             if audio_path:
                 temp_files.append(audio_path)
                 print(f"音声生成成功: {audio_path}")
             else:
-                print(f"音声生成失敗: {cleaned_text}")
+                print(f"音声生成失敗: {line['text']}")
         
         if not temp_files:
             return {"error": "音声生成に失敗しました"}, 500
@@ -234,131 +751,325 @@ def synthesize():
         print(f"{len(temp_files)}個の音声ファイルを結合中...")
         combined_path = combine_audio_files(temp_files, final_audio_path)
         
-        if AUDIO_MERGE_AVAILABLE:
-            # pydubで結合できた場合
-            if not combined_path:
-                return {"error": "音声ファイルの結合に失敗しました"}, 500
-
-            # 一時ファイルを削除
-            for temp_file in temp_files:
-                try:
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                        print(f"一時ファイルを削除: {temp_file}")
-                except Exception as e:
-                    print(f"一時ファイル削除エラー: {e}")
-
-            return {"success": True, "combined_filename": os.path.basename(combined_path)}
-        else:
-            # pydubがない環境では「結合せず」に複数ファイルを順次再生させる
-            file_names_only = [os.path.basename(p) for p in temp_files if os.path.exists(p)]
-            if not file_names_only:
-                return {"error": "音声ファイルの生成に失敗しました"}, 500
+        # ffmpeg / pydub がなくても MP3 をそのまま連結するので、結合ファイルは常にできる
+        if not combined_path:
+            return {"error": "音声ファイルの結合に失敗しました"}, 500
+
+        # 一時ファイルの削除はレスポンスを返した後にバックグラウンドで行う（キャッシュ済みのものは残す）
+        leftover_files = [p for p in temp_files if not is_cached_file(p)]
+        if leftover_files:
+            @after_this_request
+            def cleanup_temp_files(response):
+                threading.Thread(target=remove_temp_files, args=(leftover_files,), daemon=True).start()
+                return response
 
-            print("pydub未導入のため、複数ファイルを順次再生します")
-            return {"success": True, "filenames": file_names_only}
+        return {"success": True, "combined_filename": os.path.basename(combined_path)}
     except Exception as e:
         import traceback
         print(traceback.format_exc())
         return {"error": f"予期せぬエラー: {e}"}, 500
 
+def wav_stream_header(sample_rate, channels=1, sample_width=2):
+    """長さ未知のまま配信する WAV のヘッダ（サイズ欄は最大値にしておく）"""
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 0xFFFFFFFF, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate,
+        sample_rate * channels * sample_width, channels * sample_width, sample_width * 8,
+        b"data", 0xFFFFFFFF,
+    )
+
+def wav_pcm_data(wav_bytes):
+    """WAV の data チャンクの中身（PCM）を返す（ヘッダがなければそのまま PCM とみなす）"""
+    if wav_bytes[:4] != b"RIFF":
+        return wav_bytes
+    pos = 12
+    while pos + 8 <= len(wav_bytes):
+        chunk_id, size = struct.unpack_from("<4sI", wav_bytes, pos)
+        if chunk_id == b"data":
+            return wav_bytes[pos + 8:pos + 8 + size]
+        pos += 8 + size + (size & 1)
+    raise ValueError("WAV に data チャンクがありません")
+
+def decode_mp3_to_pcm(mp3_path):
+    """MP3 をストリーミング合成と同じ形式（16bit モノラル）の PCM にデコードする"""
+    return subprocess.run([
+        FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-i", mp3_path,
+        "-f", "s16le", "-ac", "1", "-ar", str(GOOGLE_STREAMING_SAMPLE_RATE), "pipe:1",
+    ], check=True, capture_output=True).stdout
+
+def iter_file_chunks(f):
+    """開いたファイルを、小さいチャンクから倍々に大きくしながら読み出す（先頭を早く送り、全体はメモリに載せない）"""
+    size = STREAM_FIRST_CHUNK_SIZE
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        yield chunk
+        size = min(size * 2, STREAM_MAX_CHUNK_SIZE)
+
+def generate_mp3_stream(lines):
+    """compact_lines でまとめた行ごとの MP3 を順に送る（MP3 フレームは自己同期的なのでそのまま連結できる）"""
+    # 全行を最初に投入し、i 行目を送っている間に後続の行を合成しておく。
+    # 同じ話者の同じセリフは 1 回だけ合成し、最後に使う行を送り終えるまで一時ファイルを残す
+    executor = ThreadPoolExecutor(max_workers=STREAM_PREFETCH_WORKERS)
+    futures = {}
+    remaining = {}
+    pending = deque()
+    for line in lines:
+        key = (line["text"], line["id"])
+        if key not in futures:
+            futures[key] = executor.submit(cached_synth, *key)
+        remaining[key] = remaining.get(key, 0) + 1
+        pending.append((line, key))
+    try:
+        while pending:
+            line, key = pending.popleft()
+            remaining[key] -= 1
+            audio_path = futures[key].result()
+            if not audio_path:
+                print(f"音声生成失敗: {line['text']}")
+                continue
+            try:
+                with open(audio_path, "rb") as f:
+                    yield from iter_file_chunks(f)
+            finally:
+                if not remaining[key] and not is_cached_file(audio_path):
+                    try:
+                        os.remove(audio_path)
+                    except OSError as e:
+                        print(f"一時ファイル削除エラー: {e}")
+    finally:
+        # クライアントが切断した場合は未着手の合成を取り消す
+        for future in futures.values():
+            future.cancel()
+        executor.shutdown(wait=False)
+
+def open_cached_pcm(text, speaker_id, lang="ja"):
+    """キャッシュ済みのストリーミング合成の PCM ファイルを開いて返す（なければ None）"""
+    cached = find_cached_audio(text, get_voice_signature(speaker_id, "google_stream"), lang, ".pcm")
+    if not cached:
+        return None
+    try:
+        return open(cached, "rb")
+    except OSError:
+        return None
+
+def read_cached_pcm(text, speaker_id, lang="ja"):
+    """キャッシュ済みのストリーミング合成の PCM を返す（なければ None）"""
+    f = open_cached_pcm(text, speaker_id, lang)
+    if f is None:
+        return None
+    try:
+        with f:
+            return f.read()
+    except OSError:
+        return None
+
+def store_cached_pcm(pcm, text, speaker_id, lang="ja"):
+    if not pcm:
+        return
+    temp_path = None
+    try:
+        temp_path = new_temp_path("temp_pcm_", suffix=".pcm")
+        with open(temp_path, "wb") as f:
+            f.write(pcm)
+    except OSError as e:
+        print(f"キャッシュ保存に失敗: {e}")
+        discard_file(temp_path)
+        return
+    path = store_cached_audio(temp_path, text, get_voice_signature(speaker_id, "google_stream"),
+                              speaker_id, lang, ".pcm")
+    if not is_cached_file(path):
+        discard_file(path)
+
+def fetch_google_pcm(text, speaker_id):
+    """ストリーミング合成の結果をまとめて受け取る（先読み用。キャッシュがあれば合成しない）"""
+    pcm = read_cached_pcm(text, speaker_id)
+    if pcm is None:
+        with _tts_semaphore:
+            pcm = b"".join(stream_text_google_tts(text, speaker_id))
+        store_cached_pcm(pcm, text, speaker_id)
+    return pcm
+
+class GooglePcmStream:
+    """1 行目の PCM を届いた順に返すイテレータ。
+    最初のチャンクを受け取るところまで生成時に行うので、Google TTS が使えなければ生成時に例外になる。
+    合成中は _tts_semaphore を 1 つ使い、送り終えるか close() されたときに返す。
+    キャッシュがあれば、ファイルから少しずつ読み出して送る"""
+
+    def __init__(self, text, speaker_id):
+        self.text = text
+        self.speaker_id = speaker_id
+        self._chunks = None
+        self._file = open_cached_pcm(text, speaker_id)
+        if self._file is not None:
+            return
+        _tts_semaphore.acquire()
+        try:
+            self._chunks = stream_text_google_tts(text, speaker_id)
+            self._first = next(self._chunks, b"")
+        except BaseException:
+            self.close()
+            raise
+
+    def __iter__(self):
+        if self._file is not None:
+            try:
+                yield from iter_file_chunks(self._file)
+            finally:
+                self.close()
+            return
+        if self._chunks is None:
+            return
+        received = [self._first]
+        try:
+            yield self._first
+            for chunk in self._chunks:
+                received.append(chunk)
+                yield chunk
+        finally:
+            self.close()
+        store_cached_pcm(b"".join(received), self.text, self.speaker_id)
+
+    def close(self):
+        """合成を打ち切ってセマフォを返す（何度呼んでもよい）"""
+        f, self._file = self._file, None
+        if f is not None:
+            f.close()
+        chunks, self._chunks = self._chunks, None
+        if chunks is not None:
+            chunks.close()
+            _tts_semaphore.release()
+
+def synthesize_line_pcm(text, speaker_id):
+    """ストリーミング合成に失敗した行を、別の方法で PCM にする（WAV のヘッダを送った後なので MP3 には切り替えられない）。
+    ストリーミング合成の再試行 → 通常合成の LINEAR16 → （ffmpeg があれば）gTTS などの MP3 をデコード、の順に試す"""
+    try:
+        return fetch_google_pcm(text, speaker_id)
+    except Exception as e:
+        print(f"Google TTS streaming synth failed again: {e}")
+    pcm = synthesize_pcm_google_tts(text, speaker_id)
+    if pcm:
+        return pcm
+    if FFMPEG_PATH:
+        audio_path = cached_synth(text, speaker_id)
+        if audio_path:
+            try:
+                return decode_mp3_to_pcm(audio_path)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"MP3 のデコードに失敗: {e}")
+            finally:
+                if not is_cached_file(audio_path):
+                    discard_file(audio_path)
+    return None
+
+def completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+def generate_wav_stream(lines, first_pcm):
+    """compact_lines でまとめた行を Google TTS でストリーミング合成し、届いた PCM から順に WAV として送る
+    （first_pcm は開始済みの 1 行目の GooglePcmStream）"""
+    yield wav_stream_header(GOOGLE_STREAMING_SAMPLE_RATE)
+
+    # 1 行目はそのままストリーミングし、その間に 2 行目以降を先読みする
+    # （同じ話者の同じセリフは 1 回だけ合成し、PCM を使い回す）
+    first_key = (lines[0]["text"], lines[0]["id"])
+    executor = ThreadPoolExecutor(max_workers=STREAM_PREFETCH_WORKERS)
+    futures = {}
+    pending = deque()
+    for line in lines[1:]:
+        key = (line["text"], line["id"])
+        if key != first_key and key not in futures:
+            futures[key] = executor.submit(fetch_google_pcm, *key)
+        pending.append(key)
+    try:
+        chunks = []
+        try:
+            for chunk in first_pcm:
+                chunks.append(chunk)
+                yield chunk
+            pcm = b"".join(chunks)
+        except Exception as e:
+            print(f"Google TTS streaming synth failed: {e}")
+            # 途中まで送っていても行を飛ばさないよう、1 行分を改めて送る（サンプルの区切りは合わせておく）
+            if sum(len(chunk) for chunk in chunks) % 2:
+                yield b"\0"
+            pcm = synthesize_line_pcm(*first_key)
+            if pcm:
+                yield pcm
+        if pcm:
+            yield PCM_SILENCE
+            if first_key in pending:
+                futures[first_key] = completed_future(pcm)
+        else:
+            print(f"音声生成失敗: {first_key[0]}")
+        while pending:
+            key = pending.popleft()
+            if key not in futures:
+                # 1 行目と同じセリフで、1 行目の合成に失敗していた場合は改めて合成する
+                futures[key] = executor.submit(fetch_google_pcm, *key)
+            try:
+                pcm = futures[key].result()
+            except Exception as e:
+                print(f"Google TTS streaming synth failed: {e}")
+                pcm = synthesize_line_pcm(*key)
+                # 同じセリフが後にもあれば、この結果を使い回す
+                futures[key] = completed_future(pcm)
+            if not pcm:
+                print(f"音声生成失敗: {key[0]}")
+                continue
+            yield pcm
+            yield PCM_SILENCE
+    finally:
+        for future in futures.values():
+            future.cancel()
+        executor.shutdown(wait=False)
+
+@app.route("/synthesize_stream")
+def synthesize_stream():
+    """合成できた行から順に音声をストリーミング配信する"""
+    file_path = get_text_file_path()
+    if not os.path.exists(file_path):
+        return {"error": "text.txtがありません"}, 400
+    lines = get_batches(file_path)
+    if not lines:
+        return {"error": "合成するデータがありません"}, 400
+
+    first_pcm = None
+    if get_tts_client() and GOOGLE_TTS_STREAMING_AVAILABLE:
+        # 1 行目の最初の音が届くまで待ってから WAV で返すか決める（権限・クォータのエラーなら gTTS などの MP3 にする）
+        try:
+            first_pcm = GooglePcmStream(lines[0]["text"], lines[0]["id"])
+        except Exception as e:
+            print(f"Google TTS streaming synth failed, falling back to MP3: {e}")
+    if first_pcm is not None:
+        response = Response(stream_with_context(generate_wav_stream(lines, first_pcm)), mimetype="audio/wav")
+        # クライアントが受信を始める前に切断しても、合成を打ち切ってセマフォを返す
+        response.call_on_close(first_pcm.close)
+    else:
+        response = Response(stream_with_context(generate_mp3_stream(lines)), mimetype="audio/mpeg")
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
 @app.route("/audio/<path:filename>")
 def get_audio(filename):
-    fp = os.path.join(OUTPUT_DIR, filename)
-    if not os.path.exists(fp):
+    fp = safe_join(OUTPUT_DIR, filename)
+    # 返すのは OUTPUT_DIR 直下の MP3 だけ（cache/ 内のメタデータや PCM などは返さない）
+    if (fp is None or not fp.endswith(".mp3")
+            or os.path.dirname(os.path.abspath(fp)) != os.path.abspath(OUTPUT_DIR)
+            or not os.path.isfile(fp)):
         return "Not found", 404
-    return send_file(fp, mimetype="audio/mpeg")
+    # 開発サーバー（Werkzeug）には前段の nginx がいないので、その場合は自前で返す
+    if AUDIO_ACCEL_REDIRECT_PREFIX and not request.environ.get('SERVER_SOFTWARE', '').lower().startswith('werkzeug'):
+        response = Response(mimetype="audio/mpeg")
+        response.headers["X-Accel-Redirect"] = AUDIO_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(filename)
+        return response
+    # Range / If-None-Match に対応して、ブラウザがシークや途中からの再生をできるようにする
+    return send_file(fp, mimetype="audio/mpeg", conditional=True, etag=True,
+                     last_modified=os.path.getmtime(fp), max_age=AUDIO_MAX_AGE)
 
 if __name__ == "__main__":
-    os.makedirs("templates", exist_ok=True)
-    with open("templates/index.html", "w", encoding="utf-8") as f:
-        f.write('''<!DOCTYPE html>
-<html>
-<head>
-    <title>音声合成アプリ (gTTS)</title>
-    <meta charset="utf-8">
-    <style>
-        body { font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; }
-        .dialogue-line { margin: 10px 0; padding: 10px; border: 1px solid #ccc; }
-        .controls { margin: 20px 0; }
-        button { padding: 10px 20px; background: #4CAF50; color: white; border: none; cursor: pointer; margin: 5px; }
-        button:hover { background: #45a049; }
-        #status { margin: 10px 0; padding: 10px; }
-        .success { background: #dff0d8; color: #3c763d; }
-        .error { background: #f2dede; color: #a94442; }
-    </style>
-</head>
-<body>
-    <h1>音声合成アプリ (gTTS)</h1>
-    <div id="status"></div>
-    <div class="controls">
-        <button onclick="synthesize()" id="synthesizeButton">音声を合成</button>
-    </div>
-    <div id="dialogue"></div>
-
-    <script>
-        let currentLines = {{ lines|tojson|safe if lines else '[]' }};
-        function showStatus(msg, isError=false) {
-            const status = document.getElementById('status');
-            status.textContent = msg;
-            status.className = isError ? 'error' : 'success';
-        }
-        function updateDialogueDisplay() {
-            const div = document.getElementById('dialogue');
-            div.innerHTML = currentLines.map(line => 
-                '<div class="dialogue-line">' +
-                    '<p>テキスト: ' + line.text + '</p>' +
-                    '<p>話者: ' + (line.id===0?"男性":"女性") + '</p>' +
-                '</div>'
-            ).join('');
-        }
-        window.onload = function() {
-            updateDialogueDisplay();
-            if(currentLines.length>0) showStatus('text.txtを読み込みました！');
-        }
-        function playSequential(names) {
-            let idx = 0;
-            const audio = new Audio('/audio/' + names[idx]);
-            audio.addEventListener('ended', () => {
-                idx++;
-                if (idx < names.length) {
-                    audio.src = '/audio/' + names[idx];
-                    audio.play();
-                }
-            });
-            audio.play();
-        }
-        function synthesize() {
-            if(currentLines.length===0) { showStatus('合成データなし',true); return; }
-            showStatus('音声生成中...');
-            document.getElementById('synthesizeButton').disabled=true;
-            fetch('/synthesize',{method:'POST'})
-            .then(r=>r.json())
-            .then(data=>{
-                document.getElementById('synthesizeButton').disabled=false;
-                if(data.error){ showStatus('エラー: '+data.error,true); return; }
-                showStatus('音声生成完了！');
-
-                // pydubあり: 単一の結合ファイルを再生
-                if (data.combined_filename) {
-                    const audio = new Audio('/audio/' + data.combined_filename);
-                    audio.play();
-                    return;
-                }
-
-                // pydubなし: 複数ファイルを順次再生
-                if (Array.isArray(data.filenames) && data.filenames.length > 0) {
-                    playSequential(data.filenames);
-                    return;
-                }
-
-                showStatus('再生可能なファイルが見つかりませんでした。', true);
-            }).catch(e=>{
-                document.getElementById('synthesizeButton').disabled=false;
-                showStatus('エラー: '+e,true);
-            });
-        }
-    </script>
-</body>
-</html>''')
-    app.run(host='0.0.0.0', port=8001, debug=True)
+    app.run(host='0.0.0.0', port=8001, debug=os.environ.get('FLASK_DEBUG') == '1')